@@ -1,11 +1,10 @@
 #!/usr/bin/env python3
 """Terminus Tenebris: a sunrise/sunset utility."""
 
+import collections
 import datetime
-from math import (
-    sin, cos, tan,
-    asin, acos, atan, atan2,
-    radians, degrees)
+import functools
+from math import sin, cos, asin, atan2, sqrt, pi
 
 import bottle
 
@@ -21,45 +20,73 @@ body {
 </style>
 '''
 
+# Pages are rendered to bytes once at import; TIMES_PAGE takes the dawn
+# and dusk times as %-format arguments
+TIMES_PAGE = f'''\
+<!DOCTYPE html>
+<html>
+  <head>
+    <meta charset="UTF-8" />
+    <title>Terminus Tenebris</title>
+    {STYLE}
+  </head>
+  <body>
+    <center>
+      Dawn: <b>%s</b><br />
+      Dusk: <b>%s</b>
+    </center>
+  </body>
+</html>
+'''.encode()
+INVALID_DATE_PAGE = f'''\
+<!DOCTYPE html>
+<html>
+  <head>
+    <meta charset="UTF-8" />
+    <title>Terminus Tenebris</title>
+    {STYLE}
+  </head>
+  <body>
+    <center>
+      Invalid date specification
+    </center>
+  </body>
+</html>
+'''.encode()
+
 # Number of leap seconds since 2000-01-01 as of 2021-01-01
 LEAP_SECONDS = datetime.timedelta(seconds=5)
 TIME_EPOCH = datetime.datetime(
     2000, 1, 1, hour=12, tzinfo=datetime.timezone.utc)
+# POSIX timestamp of TIME_EPOCH, corrected for leap seconds
+EPOCH_TS = TIME_EPOCH.timestamp() - LEAP_SECONDS.total_seconds()
 
-deg_func = lambda f : lambda x : f(radians(x))
-sind, cosd, tand = map(deg_func, (sin, cos, tan))
-
-deg_afunc = lambda f : lambda x : degrees(f(x))
-asind, acosd, atand = map(deg_afunc, (asin, acos, atan))
-atan2d = lambda x, y : degrees(atan2(x, y))
+DEG_TO_RAD = pi/180.0
+RAD_TO_DEG = 180.0/pi
+# Sine of the obliquity of the ecliptic (23.44 degrees)
+SIN_OBLIQUITY = sin(23.44*DEG_TO_RAD)
 
 DST_OFFSET = datetime.timedelta(hours=1)
 ZERO_OFFSET = datetime.timedelta(0)
+TZEntry = collections.namedtuple('TZEntry', 'offset std_name dst_name')
 all_tz = {
-    'eastern': {
-        'offset': datetime.timedelta(hours=-5),
-        'std_name': 'EST',
-        'dst_name': 'EDT'},
-    'central': {
-        'offset': datetime.timedelta(hours=-6),
-        'std_name': 'CST',
-        'dst_name': 'CDT'},
-    'mountain': {
-        'offset': datetime.timedelta(hours=-7),
-        'std_name': 'MST',
-        'dst_name': 'MDT'},
-    'pacific': {
-        'offset': datetime.timedelta(hours=-8),
-        'std_name': 'PST',
-        'dst_name': 'PDT'},
-    'alaska': {
-        'offset': datetime.timedelta(hours=-9),
-        'std_name': 'AKST',
-        'dst_name': 'AKDT'},
-    'hawaii': {
-        'offset': datetime.timedelta(hours=-10),
-        'std_name': 'HST',
-        'dst_name': 'HDT'}}
+    'eastern': TZEntry(datetime.timedelta(hours=-5), 'EST', 'EDT'),
+    'central': TZEntry(datetime.timedelta(hours=-6), 'CST', 'CDT'),
+    'mountain': TZEntry(datetime.timedelta(hours=-7), 'MST', 'MDT'),
+    'pacific': TZEntry(datetime.timedelta(hours=-8), 'PST', 'PDT'),
+    'alaska': TZEntry(datetime.timedelta(hours=-9), 'AKST', 'AKDT'),
+    'hawaii': TZEntry(datetime.timedelta(hours=-10), 'HST', 'HDT')}
+
+@functools.lru_cache(maxsize=64)
+def _dst_bounds(year):
+    """Return the ordinals of the first and last-plus-one days of US DST."""
+    # Second Sunday in March
+    start = datetime.date(year, 3, 8)
+    start += datetime.timedelta(days=(6-start.weekday())%7)
+    # First Sunday in November
+    end = datetime.date(year, 11, 1)
+    end += datetime.timedelta(days=(6-end.weekday())%7)
+    return start.toordinal(), end.toordinal()
 
 class us_tz(datetime.tzinfo):
     """A timezone which obeys US DST rules."""
@@ -68,9 +95,9 @@ class us_tz(datetime.tzinfo):
         try:
             data = all_tz[name]
             self._dst_override = dst_override
-            self._utc_offset = data['offset']
-            self._std_name = data['std_name']
-            self._dst_name = data['dst_name']
+            self._utc_offset = data.offset
+            self._std_name = data.std_name
+            self._dst_name = data.dst_name
         except KeyError:
             self._dst_override = False
             try:
@@ -82,13 +109,24 @@ class us_tz(datetime.tzinfo):
                 # Default to UTC
                 self._utc_offset = ZERO_OFFSET
                 self._std_name = self._dst_name = 'UTC'
+        # Full UTC offsets, precomputed so utcoffset() allocates nothing
+        self._std_total = self._utc_offset
+        self._dst_total = self._utc_offset + DST_OFFSET
 
     def utcoffset(self, dt):
-        return self._utc_offset + self.dst(dt)
+        return self._dst_total if self._is_dst(dt) else self._std_total
     def dst(self, dt):
         return DST_OFFSET if self._is_dst(dt) else ZERO_OFFSET
     def tzname(self, dt):
         return self._dst_name if self._is_dst(dt) else self._std_name
+    def fromutc(self, dt):
+        # Equivalent to the default tzinfo.fromutc(), which would call
+        # utcoffset() once and dst() twice, but with a single DST check on
+        # the local standard time
+        if dt.tzinfo is not self:
+            raise ValueError('fromutc: dt.tzinfo is not self')
+        dt += self._std_total
+        return dt + DST_OFFSET if self._is_dst(dt) else dt
 
     def _is_dst(self, dt):
         # Since 2007 in the United States, DST has run from the second Sunday
@@ -98,64 +136,122 @@ class us_tz(datetime.tzinfo):
         # midnight instead).
         if self._dst_override is not None:
             return self._dst_override
-        if dt.month in (4, 5, 6, 7, 8, 9, 10):
-            return True
-        if dt.month in (1, 2, 12):
-            return False
-        wd = dt.isoweekday()%7 # Let Sunday be zero
-        last_sunday = dt.day - wd # Month day of the previous Sunday
-        if dt.month == 3: # DST begins in March
-            return last_sunday > 7 # Second Sunday or later
-        # DST ends in November
-        return last_sunday > 0 # First Sunday or later
+        dst_start, dst_end = _dst_bounds(dt.year)
+        return dst_start <= dt.toordinal() < dst_end
 central_time = us_tz('central')
 
-def sun_times(latitude_deg, longitude_deg, dt):
-    """Calculate sunrise/sunset parameters.
+@functools.lru_cache(maxsize=32)
+def get_tz(name, dst_override=None):
+    """Return a shared `us_tz` instance for the given arguments."""
+    return us_tz(name, dst_override=dst_override)
 
-    These equations were adapted from Wikipedia:
-    https://en.wikipedia.org/wiki/Sunrise_equation
+# Solar elevations (degrees) at which the events of interest occur
+SUNSET_DEG = -0.83
+CIVIL_TWILIGHT_DEG = -6.0
+
+@functools.lru_cache(maxsize=4096)
+def _compute_transit(latitude_deg, longitude_deg, day):
+    """Calculate solar noon and the terms needed for hour angles.
+
+    `day` is the whole Julian day relative to 2000-01-01T12:00:00Z. Returns
+    the Julian date of solar noon (days) together with the products
+    sin(latitude)*sin(declination) and cos(latitude)*cos(declination)
+    consumed by `_half_daylight`. The result depends only on the
+    arguments, so it is cached: repeated requests for the same place on
+    the same day skip the trigonometry entirely.
     """
-    # Julian date relative to 2000-01-01T12:00:00Z (days)
-    n = (dt-TIME_EPOCH+LEAP_SECONDS).total_seconds() / 86400.0
+    # Mean solar time (days)
+    J_star = day - longitude_deg/360.0
     # Mean solar anomaly (degrees)
-    M = (357.5291 + 985.600_280e-3*n) % 360
+    M = (357.5291 + 985.600_280e-3*J_star) % 360
+    # Shared by the equation of the center and the equation of time
+    sin_M = sin(M*DEG_TO_RAD)
+    # sin(2M) from the double-angle identity (one cos call); sin(3M) from
+    # the triple-angle identity (no call)
+    sin_2M = 2*sin_M*cos(M*DEG_TO_RAD)
+    sin_3M = sin_M*(3 - 4*sin_M*sin_M)
     # Equation of the center (degrees)
-    C = 1.9148*sind(M) + 20e-3*sind(2*M) + 300e-6*sind(3*M)
+    C = 1.9148*sin_M + 20e-3*sin_2M + 300e-6*sin_3M
     # Ecliptic longitude (degrees)
-    lam = sum((M, C, 180.0, 102.9372)) % 360
+    lam = (M + C + 180.0 + 102.9372) % 360
     # Equation of time (days)
-    eq_of_time_day = - 5.3e-3*sind(M) + 6.9e-3*sind(2*lam)
-    # Declination of the sun (degrees)
-    delta = asind(sind(lam)*sind(23.44))
-
-    # Hour angle of the sun at the specified position above the horizon
-    # given in hours either side of solar noon
-    omega = lambda theta : acosd(
-        (sind(theta) - sind(latitude_deg)*sind(delta))
-        /(cosd(latitude_deg)*cosd(delta))) / 15.0
-    sunset_deg = -0.83
-    civil_twilight_deg = -6.0
+    eq_of_time_day = - 5.3e-3*sin_M + 6.9e-3*sin(2*lam*DEG_TO_RAD)
+    # Declination of the sun (radians)
+    delta = asin(sin(lam*DEG_TO_RAD)*SIN_OBLIQUITY)
 
     # Solar noon
-    n_transit = int(n) - longitude_deg/360.0 - eq_of_time_day
-    dt_transit = (
-        TIME_EPOCH-LEAP_SECONDS
-        + datetime.timedelta(days=n_transit)).astimezone(dt.tzinfo)
+    n_transit = J_star - eq_of_time_day
+    return (
+        n_transit,
+        sin(latitude_deg*DEG_TO_RAD)*sin(delta),
+        cos(latitude_deg*DEG_TO_RAD)*cos(delta))
+
+@functools.lru_cache(maxsize=4096)
+def _half_daylight(theta, sin_lat_sin_delta, cos_lat_cos_delta):
+    """Return the hour angle of the sun at elevation `theta` (degrees).
+
+    The result is given in hours either side of solar noon.
+    """
+    x = (sin(theta*DEG_TO_RAD) - sin_lat_sin_delta)/cos_lat_cos_delta
+    # The sun never rises above (polar night) or never sets below
+    # (midnight sun) the given angle on this day
+    if x >= 1.0:
+        return 0.0
+    if x <= -1.0:
+        return 12.0
+    return atan2(sqrt(1.0 - x*x), x)*RAD_TO_DEG / 15.0
+
+def _transit(latitude_deg, longitude_deg, dt):
+    """Return solar noon as a datetime plus the `_half_daylight` terms."""
+    # Julian date relative to 2000-01-01T12:00:00Z (days)
+    n = (dt.timestamp()-EPOCH_TS) / 86400.0
+    # Coordinates are rounded to 4 decimal places (~10 m) so that nearby
+    # requests share cache entries
+    n_transit, sin_lat_sin_delta, cos_lat_cos_delta = _compute_transit(
+        round(latitude_deg, 4), round(longitude_deg, 4), int(n))
+
+    dt_transit = datetime.datetime.fromtimestamp(
+        EPOCH_TS + n_transit*86400.0, tz=dt.tzinfo)
+    return dt_transit, sin_lat_sin_delta, cos_lat_cos_delta
+
+def _twilight(dt_transit, terms):
+    """Return dawn and dusk (civil twilight) around `dt_transit`."""
+    half_daylight_1 = datetime.timedelta(
+        hours=_half_daylight(CIVIL_TWILIGHT_DEG, *terms))
+    return {
+        'dawn': dt_transit - half_daylight_1,
+        'dusk': dt_transit + half_daylight_1}
+
+def sun_times(latitude_deg, longitude_deg, dt):
+    """Calculate sunrise/sunset parameters.
+
+    These equations were adapted from Wikipedia:
+    https://en.wikipedia.org/wiki/Sunrise_equation
+    """
+    dt_transit, *terms = _transit(latitude_deg, longitude_deg, dt)
 
     out = {'noon': dt_transit}
     # Excludes civil twilight
-    half_daylight_0 = datetime.timedelta(hours=omega(sunset_deg))
+    half_daylight_0 = datetime.timedelta(
+        hours=_half_daylight(SUNSET_DEG, *terms))
     out['sunrise'] = dt_transit - half_daylight_0
     out['sunset'] = dt_transit + half_daylight_0
 
-    # Includes civil twilight
-    half_daylight_1 = datetime.timedelta(hours=omega(civil_twilight_deg))
-    out['dawn'] = dt_transit - half_daylight_1
-    out['dusk'] = dt_transit + half_daylight_1
-
+    out.update(_twilight(dt_transit, terms))
     return out
 
+def sun_twilight(latitude_deg, longitude_deg, dt):
+    """Calculate only dawn and dusk (the civil twilight boundaries).
+
+    This skips the sunrise/sunset hour angle computed by `sun_times`.
+    """
+    dt_transit, *terms = _transit(latitude_deg, longitude_deg, dt)
+    return _twilight(dt_transit, terms)
+
+def _hms(dt):
+    """Format the time of `dt` as HH:MM:SS bytes without strftime."""
+    return b'%02d:%02d:%02d' % (dt.hour, dt.minute, dt.second)
+
 @bottle.route('/tenebris/<lat:float>/<lon:float>')
 @bottle.route('/tenebris/<lat:float>/<lon:float>/<tz>')
 @bottle.route('/tenebris/<lat:float>/<lon:float>/<tz>/at/<at>')
@@ -163,45 +259,15 @@ def sun_times(latitude_deg, longitude_deg, dt):
 def index(lat, lon, tz=None, dst=None, at=None):
     dst_override = None if dst is None else bool(dst)
     if at is None:
-        dt = datetime.datetime.now(tz=us_tz(tz, dst_override=dst_override))
+        dt = datetime.datetime.now(tz=get_tz(tz, dst_override))
     else:
         try:
-            dt = datetime.datetime.strptime(at, '%Y-%m-%d')
-            dt = dt.replace(tzinfo=us_tz(tz, dst_override=dst_override))
+            dt = datetime.datetime.strptime(at, '%Y-%m-%d').replace(
+                tzinfo=get_tz(tz, dst_override))
         except ValueError:
-            return '''\
-<!DOCTYPE html>
-<html>
-  <head>
-    <meta charset="UTF-8" />
-    <title>Terminus Tenebris</title>
-    {STYLE}
-  </head>
-  <body>
-    <center>
-      Invalid date specification
-    </center>
-  </body>
-</html>
-'''
-    times = sun_times(lat, lon, dt)
-    times_fmt = {k: v.strftime(r'%H:%M:%S') for k, v in times.items()}
-    return f'''\
-<!DOCTYPE html>
-<html>
-  <head>
-    <meta charset="UTF-8" />
-    <title>Terminus Tenebris</title>
-    {STYLE}
-  </head>
-  <body>
-    <center>
-      Dawn: <b>{times_fmt["dawn"]}</b><br />
-      Dusk: <b>{times_fmt["dusk"]}</b>
-    </center>
-  </body>
-</html>
-'''
+            return INVALID_DATE_PAGE
+    times = sun_twilight(lat, lon, dt)
+    return TIMES_PAGE % (_hms(times['dawn']), _hms(times['dusk']))
 
 if __name__ == '__main__':
-    bottle.run(host='0.0.0.0', port=8510, debug=True)
+    bottle.run(host='0.0.0.0', port=8510, server='auto', debug=True)